@@ -1,18 +1,24 @@
-import sys
 import os
+import io
 import argparse
 import pathlib
 import re
 import logging
-import json
+import asyncio
+import random
 import time
-from typing import List
-
-import requests
-
-from datetime import datetime
-from urllib.parse import urlparse
-from collections import namedtuple
+import sqlite3
+import functools
+from typing import List, Optional, Iterable, BinaryIO, Dict, Tuple
+
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
+
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, urlsplit, urlencode
+from collections import namedtuple, defaultdict
+from contextlib import closing
 from urlextract import URLExtract
 
 FORMAT = '%(asctime)s %(name)s %(levelname)-8s %(message)s'
@@ -21,17 +27,203 @@ logger = logging.getLogger("zl2wbm")
 
 BASE_WEB_ARCHIVE_URL = "https://web.archive.org"
 WAYBACK_API_URL = "https://pragma.archivelab.org"
-IGNORED_HOSTS = ["web.archive.org", "archive.is", "web-beta.archive.org", "localhost"]
+CDX_API_URL = "https://web.archive.org/cdx/search/cdx"
+IGNORED_HOSTS = frozenset({"web.archive.org", "archive.is", "web-beta.archive.org", "localhost"})
+
+# Maximum number of links being archived at the same time.
+MAX_CONCURRENT_ARCHIVES = 8
+# Maximum number of notebook pages being processed at the same time.
+MAX_CONCURRENT_FILES = 4
+
+# archive.org blocks an IP for 5 minutes when it makes more than 15 save requests per minute.
+SAVE_REQUESTS_PER_MINUTE = 15
+SAVE_BLOCK_SECONDS = 300
+
+# How many times a request is retried when archive.org answers with 429 Too Many Requests.
+MAX_RETRIES = 6
+
+ZIM_WIKI_HEADER = b"Content-Type: text/x-zim-wiki"
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "zl2wbm")
+# A snapshot that is at most this many days old is recent enough to be used instead of creating a new one.
+RECENT_SNAPSHOT_MAX_DAYS = 14
+# How long we remember that the Wayback Machine has no recent snapshot of an url.
+MISSING_SNAPSHOT_CACHE_TTL = timedelta(days=1)
+# Maximum number of snapshots returned by one CDX query. Hosts with more recent snapshots than that are not
+# looked up with CDX at all, their urls are looked up one by one.
+CDX_QUERY_LIMIT = 1000
 
 ArchivedUrl = namedtuple("ArchivedUrl", "original_url archived_url")
 
-url_extractor = URLExtract()
+# Fast way to find urls. Only finds urls with a http(s) scheme, see get_url_extractor() for the thorough way.
+# The matches can end with punctuation that isn't part of the url, see trim_url().
+URL_REGEX = re.compile(r"https?://[^\s\]\|]+")
+# Characters that end a sentence or a quote, rather than a url, when they are at the end of one.
+URL_TRAILING_PUNCTUATION = ".,;:!?'\""
+
+METACHARACTERS_TRANSLATION_TABLE = str.maketrans({c: "\\" + c for c in "&[]|?"})
+
+# Matches the location of an archive made by /save/. Ex: /web/20170813163039/http://www.google.ca/
+ARCHIVE_LOCATION_REGEX = re.compile(r"/web/\d{14}/\S+")
+
+# Matches a link that is followed by an "(Archive)" link, and captures the url of the link. Ex:
+# https://google.com ([[https://web.archive.org/web/20170724012307/https://google.com|Archive]])
+# [[https://google.com|Patate]] ([[https://web.archive.org/web/20170724012307/http:s//google.com|Archive]])
+# (see **https://google.com ([[https://web.archive.org/web/20170724012307/https://google.com|Archive]])**)
+ARCHIVED_LINK_REGEX = re.compile(
+    r"(?:\[\[([^|\]\s]+)\|[^\]]*\]\]|(?<![^\s(\"'*])[(\"'*]*([^\s(\"'*]\S*))\s\(\[\[[^\]]*\|Archive\]\]\)")
 
 
 class SaveLinkToWaybackMachineException(Exception):
     pass
 
 
+class Throttle:
+    """
+    Rate limit of an archive.org endpoint, shared by every request made to it: a token bucket, plus a pause that
+    every request waits for once archive.org told us (with a 429 Too Many Requests) that we are blocked anyway.
+    """
+
+    def __init__(self, max_rate: float, time_period: float, block_seconds: float):
+        """
+        :param max_rate: number of requests allowed per time_period
+        :param time_period: in seconds
+        :param block_seconds: how long archive.org blocks us when we make too many requests
+        """
+        self.limiter = AsyncLimiter(max_rate, time_period)
+        self.block_seconds = block_seconds
+        self.blocked_until = 0.0
+
+    async def acquire(self) -> None:
+        await self.wait_until_unblocked()
+        await self.limiter.acquire()
+        # Another request may have been blocked while we were waiting for a token.
+        await self.wait_until_unblocked()
+
+    async def wait_until_unblocked(self) -> None:
+        while self.blocked_until > time.monotonic():
+            await asyncio.sleep(self.blocked_until - time.monotonic())
+
+    def block(self, delay: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+
+save_throttle = Throttle(SAVE_REQUESTS_PER_MINUTE, 60, SAVE_BLOCK_SECONDS)
+
+
+class SnapshotCache:
+    """
+    Remembers the snapshot of every url we looked up or archived, and the urls that have no recent snapshot.
+    Every answer is written to disk as soon as we get it, so that an interrupted crawl doesn't redo that work
+    (and spend its rate limit on it) when it's resumed.
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS snapshots(url TEXT PRIMARY KEY, archived_url TEXT, ts INTEGER)")
+        # Forget the answers that get() would no longer trust, so that the cache doesn't grow forever.
+        current_date = datetime.now()
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM snapshots WHERE (archived_url IS NOT NULL AND ts < ?) OR (archived_url IS NULL AND ts < ?)",
+                (int((current_date - timedelta(days=RECENT_SNAPSHOT_MAX_DAYS + 1)).timestamp()),
+                 int((current_date - MISSING_SNAPSHOT_CACHE_TTL).timestamp())))
+        self.snapshots = {url: {"ts": datetime.fromtimestamp(ts), "archived_url": archived_url} for url, archived_url, ts in
+                          self.connection.execute("SELECT url, archived_url, ts FROM snapshots")}
+
+    def get(self, url: str) -> Optional[dict]:
+        """
+        :param url: url we want a snapshot of
+        :return: the cached answer, or None if there is none or if it's too old to be trusted.
+        """
+        cached_snapshot = self.snapshots.get(url)
+        current_date = datetime.now()
+
+        if not cached_snapshot:
+            return None
+
+        if cached_snapshot["archived_url"] and (current_date - cached_snapshot["ts"]).days <= RECENT_SNAPSHOT_MAX_DAYS:
+            return cached_snapshot
+
+        if not cached_snapshot["archived_url"] and current_date - cached_snapshot["ts"] < MISSING_SNAPSHOT_CACHE_TTL:
+            return cached_snapshot
+
+        return None
+
+    def add(self, url: str, archived_url: Optional[str], snapshot_date: datetime) -> None:
+        """
+        :param url: url we looked up or archived
+        :param archived_url: url of its snapshot, or None if it has no recent snapshot
+        :param snapshot_date: date of the snapshot, or date of the lookup if it has no recent snapshot
+        """
+        self.add_many([(url, archived_url, snapshot_date)])
+
+    def add_many(self, snapshots: List[Tuple[str, Optional[str], datetime]]) -> None:
+        """
+        Same as add(), but writes all the snapshots in a single transaction.
+
+        :param snapshots: (url, archived_url, snapshot_date) of every url
+        """
+        for url, archived_url, snapshot_date in snapshots:
+            self.snapshots[url] = {"ts": snapshot_date, "archived_url": archived_url}
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                                        ((url, archived_url, int(snapshot_date.timestamp()))
+                                         for url, archived_url, snapshot_date in snapshots))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_url_extractor() -> URLExtract:
+    # URLExtract is slow to create (it loads the list of all top level domains), so we only create it when needed.
+    return URLExtract()
+
+
+@functools.lru_cache(maxsize=10000)
+def get_hostname(url: str) -> Optional[str]:
+    """
+    >>> get_hostname("http://google.com/maps")
+    'google.com'
+    >>> get_hostname("http://[::1") is None
+    True
+
+    :param url:
+    :return: the hostname of the url, or None if it has none or if it's not a valid url.
+    """
+    # The same urls are parsed over and over (once per page they're in, and again while archiving them).
+    try:
+        return urlparse(url).hostname
+    except ValueError:
+        return None
+
+
+def trim_url(url: str) -> str:
+    """
+    Remove the punctuation that follows a url in a sentence, and Zim's bold markup, from the end of a url.
+    >>> trim_url("http://google.com).")
+    'http://google.com'
+    >>> trim_url("http://google.com**")
+    'http://google.com'
+    >>> trim_url("https://en.wikipedia.org/wiki/Zim_(software)")
+    'https://en.wikipedia.org/wiki/Zim_(software)'
+
+    :param url:
+    :return:
+    """
+    while True:
+        if url.endswith("**"):
+            url = url[:-2]
+        elif url.endswith(")") and url.count(")") > url.count("("):
+            url = url[:-1]
+        elif url and url[-1] in URL_TRAILING_PUNCTUATION:
+            url = url[:-1]
+        else:
+            return url
+
+
 def get_args():
     class IsValidZimNotebookAction(argparse.Action):
         def __call__(self, parser: argparse.ArgumentParser, namespace: argparse.Namespace, values,
@@ -64,38 +256,243 @@ def get_args():
                         action=LoggingAction,
                         default="DEBUG")
 
+    parser.add_argument("-s", "--strict",
+                        help="Also find urls without a scheme (ex: google.com). Slower.",
+                        action="store_true")
+
     return parser.parse_args()
 
 
-def save_link_in_wayback_machine(url: str) -> str:
-    url = url if '://' in url else 'http://' + url
-    archived_url = None
+async def get_with_retries(session: aiohttp.ClientSession, url: str,
+                           throttle: Optional[Throttle] = None) -> aiohttp.ClientResponse:
+    """
+    GET an url, backing off exponentially when the server answers 429 Too Many Requests.
+    Honors the Retry-After header when there is one.
+    :param session: session used to make the request
+    :param url: url to GET
+    :param throttle: if given, every attempt waits for it, and a 429 pauses every request that uses it
+                     (for throttle.block_seconds, unless the server says otherwise).
+    :return: the response, with its body already read
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if throttle is not None:
+            await throttle.acquire()
+
+        async with session.get(url) as r:
+            if r.status != 429 or attempt == MAX_RETRIES:
+                await r.read()
+                return r
+
+            retry_after = r.headers.get("Retry-After", "")
+
+        if retry_after.isdigit():
+            delay = float(retry_after)
+        elif throttle is not None:
+            # We are most likely blocked, and backing off for less than the block would only prolong it.
+            delay = throttle.block_seconds + random.uniform(0, 1)
+        else:
+            delay = min(300, 2 ** attempt) + random.uniform(0, 1)
+
+        logger.warning("Too many requests while getting {0}. Retrying in {1:.1f} seconds.".format(url, delay))
+
+        if throttle is not None:
+            # Every request using the throttle waits, not just this one.
+            throttle.block(delay)
+        else:
+            await asyncio.sleep(delay)
+
+
+def cdx_url_key(url: str) -> Optional[str]:
+    """
+    Canonicalize an url the same way the CDX API does for its urlkey field (SURT form), so that we can match
+    our urls with its answers.
+    >>> cdx_url_key("https://www.Example.com:443/Path/?b=2&a=1#top")
+    'com,example)/path?a=1&b=2'
+    >>> cdx_url_key("http://example.com")
+    'com,example)/'
+    >>> cdx_url_key("http://example.com:8080/")
+    'com,example:8080)/'
+
+    :param url:
+    :return: the key of the url, or None if it's not a valid url.
+    """
+    try:
+        parsed_url = urlsplit(url.lower())
+        port = parsed_url.port
+    except ValueError:
+        return None
+
+    if not parsed_url.hostname:
+        return None
+
+    host = ",".join(reversed(re.sub(r"^www\d*\.", "", parsed_url.hostname).split(".")))
+    if port and port not in (80, 443):
+        host += ":{0}".format(port)
+
+    path = parsed_url.path.rstrip("/") or "/"
+    query = "&".join(sorted(argument for argument in parsed_url.query.split("&") if argument))
+
+    return "{0}){1}{2}".format(host, path, "?" + query if query else "")
+
+
+async def find_recent_snapshots_of_host(session: aiohttp.ClientSession, host: str) -> Optional[Dict[str, dict]]:
+    """
+    Look for the recent snapshots of every url of a host, with one CDX query.
+    Uses the API described here: https://github.com/internetarchive/wayback/tree/master/wayback-cdx-server
+    :param session: session used to query the Wayback Machine
+    :param host: host we want snapshots of
+    :return: the snapshots (as cached by find_recent_snapshot()) by cdx_url_key, or None if the host has too many
+             snapshots to get them all at once or if the query failed.
+    """
+    logger.debug("Checking to see if recent copies of urls of {0} already exist in Wayback Machine.".format(host))
+    oldest_recent_timestamp = (datetime.now() - timedelta(days=RECENT_SNAPSHOT_MAX_DAYS)).strftime("%Y%m%d%H%M%S")
+    query = urlencode({"url": host, "matchType": "host", "from": oldest_recent_timestamp, "output": "json",
+                       "fl": "urlkey,timestamp,original", "filter": "statuscode:200", "collapse": "urlkey",
+                       "limit": CDX_QUERY_LIMIT})
+
+    try:
+        r = await get_with_retries(session, CDX_API_URL + "?" + query)
+        r.raise_for_status()
+        rows = orjson.loads(await r.read())
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+        logger.info("There was an error while looking for snapshots of {0}. Checking its urls one by one.".format(host))
+        logger.exception(e)
+        return None
+
+    # The first row holds the names of the fields.
+    rows = rows[1:]
+
+    if len(rows) >= CDX_QUERY_LIMIT:
+        logger.debug("{0} has too many recent snapshots to get them all at once. Checking its urls one by one.".format(
+            host))
+        return None
+
+    return {url_key: {"ts": datetime.strptime(timestamp, "%Y%m%d%H%M%S"),
+                      "archived_url": "{0}/web/{1}/{2}".format(BASE_WEB_ARCHIVE_URL, timestamp, original_url)}
+            for url_key, timestamp, original_url in rows}
+
+
+async def find_recent_snapshots(session: aiohttp.ClientSession, urls: List[str], cache: SnapshotCache,
+                                snapshots_by_host: Dict[str, asyncio.Task]) -> None:
+    """
+    Look for recent snapshots of many urls at once, with one CDX query per host, and put them in the cache.
+    Urls of a host whose snapshots couldn't all be found are left alone, find_recent_snapshot() will check them
+    one by one.
+    :param session: session used to query the Wayback Machine
+    :param urls: urls we want snapshots of
+    :param cache: cache of previous answers
+    :param snapshots_by_host: find_recent_snapshots_of_host() tasks of the hosts already queried in this crawl, so
+                              that each host is only queried once. Filled as new hosts are queried. A host with too
+                              many snapshots (or whose query failed) keeps its None answer, so it's never queried
+                              again during the crawl and its urls are always checked one by one.
+    """
+    urls_by_host = defaultdict(list)
+    for url in urls:
+        if not cache.get(url) and cdx_url_key(url):
+            urls_by_host[get_hostname(url)].append(url)
+
+    for host, host_urls in urls_by_host.items():
+        # For a single url, the availability API is just as cheap.
+        if host not in snapshots_by_host and len(host_urls) >= 2:
+            snapshots_by_host[host] = asyncio.ensure_future(find_recent_snapshots_of_host(session, host))
+
+    # The hosts are queried at the same time, so a page only waits for the slowest one.
+    hosts = [host for host in urls_by_host if host in snapshots_by_host]
+    snapshots_of_hosts = await asyncio.gather(*(snapshots_by_host[host] for host in hosts))
+
+    current_date = datetime.now()
+    found_snapshots = []
+    for host, snapshots in zip(hosts, snapshots_of_hosts):
+        if snapshots is None:
+            continue
+
+        # We have all the recent snapshots of the host, so an url that isn't in there has no recent snapshot.
+        for url in urls_by_host[host]:
+            snapshot = snapshots.get(cdx_url_key(url))
+            if snapshot:
+                found_snapshots.append((url, snapshot["archived_url"], snapshot["ts"]))
+            else:
+                found_snapshots.append((url, None, current_date))
+
+    cache.add_many(found_snapshots)
+
+
+async def find_recent_snapshot(session: aiohttp.ClientSession, url: str, cache: SnapshotCache) -> Optional[str]:
+    """
+    Look for a recent snapshot of an url in the Wayback Machine, using the cache when we can.
+    :param session: session used to query the Wayback Machine
+    :param url: url we want a snapshot of
+    :param cache: cache of previous answers
+    :return: the url of the snapshot, or None if there is no recent snapshot
+    """
+    cached_snapshot = cache.get(url)
+    current_date = datetime.now()
+
+    if cached_snapshot and cached_snapshot["archived_url"]:
+        logger.debug("Using cached snapshot of {0}: {1}".format(url, cached_snapshot["archived_url"]))
+        return cached_snapshot["archived_url"]
+
+    if cached_snapshot:
+        logger.debug("We checked recently, no recent copy of {} exists in the Wayback Machine.".format(url))
+        return None
 
     # Let's first check if a recent copy already exists in the wayback machine
     # Uses the API described here: https://archive.org/help/wayback_api.php
     logger.debug("Checking to see if a recent copy of {} already exists in Wayback Machine.".format(url))
-    r = requests.get("http://archive.org/wayback/available?url=" + url)
-    json_response = json.loads(r.content)
+    r = await get_with_retries(session, "http://archive.org/wayback/available?url=" + url)
+    r.raise_for_status()
+    json_response = orjson.loads(await r.read())
     archived_snapshots = json_response["archived_snapshots"]
 
     if archived_snapshots:
         closest_snapshot = archived_snapshots["closest"]
 
-        current_date = datetime.now()
         closest_snapshot_timestamp = datetime.strptime(closest_snapshot["timestamp"], "%Y%m%d%H%M%S")
 
         delta = current_date - closest_snapshot_timestamp
 
         # If the latest snapshot is less than 2 weeks old, then we use that one.
-        if delta.days <= 14:
+        if delta.days <= RECENT_SNAPSHOT_MAX_DAYS:
             logger.debug("A recent copy of {0} indeeds exists in the Wayback Machine (date = {1}). Using that.".format(url,
                                                                                                                    closest_snapshot_timestamp.strftime("%Y-%m-%d %H:%M:%S")))
-            archived_url = closest_snapshot["url"]
+            cache.add(url, closest_snapshot["url"], closest_snapshot_timestamp)
+            return closest_snapshot["url"]
     else:
         logger.debug("No recent copy of {} exists in the Wayback Machine. Will create new archive.".format(url))
 
+    cache.add(url, None, current_date)
+
+    return None
+
+
+def get_archived_url(url: str, content_location: Optional[str]) -> str:
+    """
+    >>> get_archived_url("http://www.google.ca/", "/web/20170813163039/http://www.google.ca/")
+    'https://web.archive.org/web/20170813163039/http://www.google.ca/'
+    >>> get_archived_url("http://www.google.ca/", None)
+    Traceback (most recent call last):
+    ...
+    zl2wbm.SaveLinkToWaybackMachineException: No archive location in the answer to saving http://www.google.ca/: None
+
+    :param url: url that was saved
+    :param content_location: content-location header of the answer of /save/
+    :return: url of the archive
+    """
+    # content-location should look something like this: /web/20170813163039/http://www.google.ca/
+    if not content_location or not ARCHIVE_LOCATION_REGEX.fullmatch(content_location):
+        raise SaveLinkToWaybackMachineException(
+            "No archive location in the answer to saving {0}: {1}".format(url, content_location))
+
+    return BASE_WEB_ARCHIVE_URL + content_location
+
+
+async def save_link_in_wayback_machine(session: aiohttp.ClientSession, url: str, cache: SnapshotCache) -> str:
+    url = url if '://' in url else 'http://' + url
+
+    archived_url = await find_recent_snapshot(session, url, cache)
+
     if not archived_url:
-        r = requests.get('http://web.archive.org/save/%s' % url)
+        r = await get_with_retries(session, 'http://web.archive.org/save/%s' % url, throttle=save_throttle)
 
         if 'X-Archive-Wayback-Runtime-Error' in r.headers:
             raise SaveLinkToWaybackMachineException(r.headers['X-Archive-Wayback-Runtime-Error'])
@@ -103,8 +500,10 @@ def save_link_in_wayback_machine(url: str) -> str:
         if 'x-archive-wayback-liveweb-error' in r.headers:
             raise SaveLinkToWaybackMachineException(r.headers['x-archive-wayback-liveweb-error'])
 
-        # content-location should look something like this: /web/20170813163039/http://www.google.ca/
-        archived_url = BASE_WEB_ARCHIVE_URL + r.headers.get("content-location", url)
+        r.raise_for_status()
+
+        archived_url = get_archived_url(url, r.headers.get("content-location"))
+        cache.add(url, archived_url, datetime.now())
 
     logger.debug("{0} archived to {1}".format(url, archived_url))
 
@@ -118,55 +517,92 @@ def protect_string_metacharacters(s: str) -> str:
     :param s: string
     :returns: protected string
     """
-    s = re.sub('\&', '\\\&', s)
-    s = re.sub('\[', '\\\[', s)
-    s = re.sub('\]', '\\\]', s)
-    s = re.sub('\|', '\\\|', s)
-    s = re.sub('\?', '\\\?', s)
+    return s.translate(METACHARACTERS_TRANSLATION_TABLE)
 
-    return s
 
+async def archive_links(session: aiohttp.ClientSession, urls: List[str], cache: SnapshotCache,
+                        snapshots_by_host: Dict[str, asyncio.Task]) -> List[ArchivedUrl]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ARCHIVES)
 
-def archive_links(urls: List[str]) -> List[ArchivedUrl]:
-    archived_urls = []
-    for url in urls:
-        parsed_url = urlparse(url)
-
-        if parsed_url and parsed_url.hostname not in IGNORED_HOSTS:
+    async def archive_link(url: str) -> Optional[ArchivedUrl]:
+        async with semaphore:
             try:
                 logger.info("Archiving: {0}".format(url))
-                archived_urls.append(ArchivedUrl(original_url=url, archived_url=save_link_in_wayback_machine(url)))
-                time.sleep(1)  # Don't want to overload the archive.org server with requests.
-            except (requests.HTTPError, json.JSONDecodeError) as e:
+                return ArchivedUrl(original_url=url, archived_url=await save_link_in_wayback_machine(session, url, cache))
+            except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError, KeyError, ValueError,
+                    SaveLinkToWaybackMachineException) as e:
                 logger.info("There was an error while archiving the following URL: {0}. Skipping it.".format(url))
                 logger.exception(e)
 
-    return archived_urls
+    urls = [url for url in urls if get_hostname(url) not in IGNORED_HOSTS]
 
+    await find_recent_snapshots(session, urls, cache, snapshots_by_host)
 
-def get_urls_to_archive_from_text(text: str) -> List[str]:
-    urls_to_archive = []
+    results = await asyncio.gather(*(archive_link(url) for url in urls))
 
-    for url in url_extractor.find_urls(text, only_unique=True):
-        # find_urls returns this as a url for some weird reason: [[https://test.org/|Archive]]
-        # So we extract the url from that. If the url doesn't contains [[ ]] or | then nothing happens.
-        url = url.lstrip('[[').rstrip(']]').split('|', 1)[0]
+    return [archived_url for archived_url in results if archived_url]
 
-        parsed_url = urlparse(url)
-        if parsed_url.hostname and parsed_url.hostname not in IGNORED_HOSTS:
-            # For example:
-            # (:?(?:https://google.com\/)|(?:\[\[https\:\/\/google\.com\/\|.*\]\])){1}\s\(\[\[.*\|Archive\]\]\)
-            # Matches:
-            # https://google.com ([[https://web.archive.org/web/20170724012307/https://google.com|Archive]])
-            # [[https://google.com|Patate]] ([[https://web.archive.org/web/20170724012307/http:s//google.com|Archive]])
-            regex = "(:?(:?{url})|(?:\[\[{url}\|.*\]\])){{1}}\s\(\[\[.*\|Archive\]\]\)".format(url=re.escape(url))
-            link_archived = re.compile(regex)
 
-            # if there is an "(Archive)" link next to the link, then it means it has already been archived.
-            if not link_archived.search(text):
-                urls_to_archive.append(url)
+def get_urls_to_archive_from_text(text: str, strict: bool = False) -> List[str]:
+    """
+    >>> get_urls_to_archive_from_text("http://google.com ([[https://web.archive.org/web/20170724012307/http://google.com|Archive]]) http://bing.com")
+    ['http://bing.com']
+    >>> get_urls_to_archive_from_text("[[http://google.com|Google]] ([[https://web.archive.org/web/20170724012307/http://google.com|Archive]]) [[http://bing.com|Bing]]")
+    ['http://bing.com']
+    >>> get_urls_to_archive_from_text("http://google.com ([[https://web.archive.org/web/20170724012307/http://google.com|Archive]])\\nhttp://google.com")
+    []
+    >>> get_urls_to_archive_from_text("| [[http://google.com|Google]] | https://bing.com/?q=zim |")
+    ['http://google.com', 'https://bing.com/?q=zim']
+    >>> get_urls_to_archive_from_text("(see http://google.com) or **http://bing.com**.")
+    ['http://google.com', 'http://bing.com']
+    >>> get_urls_to_archive_from_text("(see http://google.com ([[https://web.archive.org/web/20170724012307/http://google.com|Archive]])) or **http://bing.com ([[https://web.archive.org/web/20170724012307/http://bing.com|Archive]])**.")
+    []
+    >>> get_urls_to_archive_from_text("see http://[::1]:8080/ and http://google.com")
+    ['http://google.com']
+    >>> get_urls_to_archive_from_text("see google.com and http://bing.com", strict=True)
+    ['google.com', 'http://bing.com']
+    >>> get_urls_to_archive_from_text("see google.com and http://bing.com")
+    ['http://bing.com']
 
-    return urls_to_archive
+    :param text:
+    :param strict: if True, also finds urls without a scheme (ex: google.com), but it's a lot slower.
+    :return:
+    """
+    return get_urls_to_archive_from_lines(text.splitlines(), strict)
+
+
+def get_urls_to_archive_from_lines(lines: Iterable[str], strict: bool = False) -> List[str]:
+    """
+    Same as get_urls_to_archive_from_text, but the text is given line by line (ex: an open file),
+    so we never need to hold the whole text in memory.
+    :param lines:
+    :param strict:
+    :return:
+    """
+    urls_to_archive = {}  # Used as an ordered set.
+    already_archived_urls = set()
+
+    for line in lines:
+        # if there is an "(Archive)" link next to a link, then it means it has already been archived.
+        already_archived_urls.update(match.group(1) or match.group(2) for match in ARCHIVED_LINK_REGEX.finditer(line))
+
+        if strict:
+            urls = get_url_extractor().find_urls(line, only_unique=True)
+        else:
+            urls = (trim_url(url) for url in URL_REGEX.findall(line))
+
+        for url in urls:
+            # find_urls returns this as a url for some weird reason: [[https://test.org/|Archive]]
+            # So we extract the url from that. If the url doesn't contains [[ ]] or | then nothing happens.
+            url = url.lstrip('[[').rstrip(']]').split('|', 1)[0]
+
+            # The url is kept as written, so that edit_text() can find it, but save_link_in_wayback_machine() will add
+            # the same default scheme to it.
+            hostname = get_hostname(url if '://' in url else 'http://' + url)
+            if hostname and hostname not in IGNORED_HOSTS:
+                urls_to_archive[url] = None
+
+    return [url for url in urls_to_archive if url not in already_archived_urls]
 
 
 def edit_text(text: str, archived_urls: List[ArchivedUrl]) -> str:
@@ -177,79 +613,122 @@ def edit_text(text: str, archived_urls: List[ArchivedUrl]) -> str:
     'Integrated link: [[http://google.com|Google]] ([[http://google.archive|Archive]])'
     >>> edit_text("No links in this text!", [ArchivedUrl(original_url='http://google.com', archived_url='http://google.archive')])
     'No links in this text!'
+    >>> edit_text("Normal link: http://google.com", [])
+    'Normal link: http://google.com'
     >>> edit_text("| | http://google.com | |", [ArchivedUrl(original_url='http://google.com', archived_url='http://google.archive')])
     '| | http://google.com ([[http://google.archive\\|Archive]]) | |'
+    >>> edit_text("http://google.com and http://bing.com", [ArchivedUrl(original_url='http://google.com', archived_url='http://google.archive'), ArchivedUrl(original_url='http://bing.com', archived_url='http://bing.archive')])
+    'http://google.com ([[http://google.archive|Archive]]) and http://bing.com ([[http://bing.archive|Archive]])'
+    >>> edit_text("http://google.com http://google.com/maps", [ArchivedUrl(original_url='http://google.com', archived_url='http://google.archive'), ArchivedUrl(original_url='http://google.com/maps', archived_url='http://maps.archive')])
+    'http://google.com ([[http://google.archive|Archive]]) http://google.com/maps ([[http://maps.archive|Archive]])'
+    >>> edit_text("(see http://google.com) or **http://bing.com**.", [ArchivedUrl(original_url='http://google.com', archived_url='http://google.archive'), ArchivedUrl(original_url='http://bing.com', archived_url='http://bing.archive')])
+    '(see http://google.com ([[http://google.archive|Archive]])) or **http://bing.com ([[http://bing.archive|Archive]])**.'
 
     :param text:
     :param archived_urls:
     :return:
     """
 
+    if not archived_urls:
+        return text
+
+    archived_url_by_original_url = {archived_url.original_url: archived_url.archived_url for archived_url in archived_urls}
+    # Longest urls first, so that a url is never cut short by another url that is a prefix of it.
+    urls = "|".join(re.escape(url) for url in sorted(archived_url_by_original_url, key=len, reverse=True))
+
+    # matches: BOL, whitespace, an opening parenthesis, quote or bold, then [[{url}|...]] or {url}, then the
+    # punctuation or bold that trim_url() strips, then whitespace or EOL, for any of the urls.
+    # Ex: [[http://google.com|Google]] or http://google.com or (see **http://google.com**).
+    link_regex = re.compile(
+        r"(?<![^\s(\"'*])(?:\[\[(?P<integrated_url>{urls})\|[^\[]*\]\]|(?P<url>{urls}))(?=(?:[{punctuation})]|\*\*)*(?:\s|$))".format(
+            urls=urls, punctuation=re.escape(URL_TRAILING_PUNCTUATION)))
+
     new_lines = []
 
     for line in text.splitlines():
-        line_to_add = line
-
-        for archived_url in archived_urls:
-            # matches: BOL or whitespace {url} EOL or whitespace. Ex: http://google.com
-            normal_link_regex = re.compile("(?:(?<=\s)|(?<=^)){url}(?=\s|$)".format(url=archived_url.original_url))
-            # matches: BOL or whitespace [{url}|... ]] whitespace or EOL. Ex: [[http://google.com|Google]]
-            zim_integrated_link_regex = re.compile(
-                "(?:(?<=\s)|(?<=^))\[\[{url}\|[^\[]*\]\](?=\s|$)".format(url=archived_url.original_url))
-
-            integrated_link_match = zim_integrated_link_regex.search(line)
-            normal_link_match = normal_link_regex.search(line)
-            if integrated_link_match:
-                effective_pattern = integrated_link_match.group(0)
-            elif normal_link_match:
-                effective_pattern = archived_url.original_url
-            else:
-                # The line doesn't have this URL (maybe it doesn't even have any), so we try with the next URL.
-                continue
+        # In a table, we must escape the | character.
+        # Note: Zim only supports ONE link per table cell. If there is more than one, it only displays the first
+        separator = "\\|" if line.startswith("|") and line.endswith("|") else "|"
 
-            if line.startswith("|") and line.endswith("|"):
-                # In a table, we must escape the | character.
-                # Note: Zim only supports ONE link per table cell. If there is more than one, it only displays the first
-                new_url = effective_pattern + " ([[{0}\\|Archive]])".format(archived_url.archived_url)
-            else:
-                new_url = effective_pattern + " ([[{0}|Archive]])".format(archived_url.archived_url)
-
-            line_to_add = re.sub(re.escape(effective_pattern), new_url, line)
+        def add_archive_link(match) -> str:
+            archived_url = archived_url_by_original_url[match.group("integrated_url") or match.group("url")]
+            return match.group(0) + " ([[{0}{1}Archive]])".format(archived_url, separator)
 
-        new_lines.append(line_to_add)
+        new_lines.append(link_regex.sub(add_archive_link, line))
 
     return "\n".join(new_lines)
 
 
-def crawl_notebook_and_archive_links(zim_notebook_directory: str) -> None:
-    text_files = pathlib.Path(zim_notebook_directory).rglob('*.txt')
+def is_zim_wiki_file(f: BinaryIO) -> bool:
+    # Only the first line tells us if it's a zim wiki file, so there is no need to read (or decode) the rest of the
+    # file. The limit makes sure we don't read a whole file that has no line breaks.
+    first_line = f.readline(len(ZIM_WIKI_HEADER) + len(b'\r\n'))
 
-    for text_file in text_files:
-        try:
-            file_contents = text_file.read_text(encoding='utf8')
-            first_line = file_contents.split('\n', 1)[0]
-        except UnicodeDecodeError:
-            logger.error("Text file \"{0}\" got UnicodeDecodeError. Skipping.".format(text_file), file=sys.stderr)
-            continue
+    return first_line.rstrip(b'\r\n') == ZIM_WIKI_HEADER
+
+
+async def archive_links_in_file(session: aiohttp.ClientSession, cache: SnapshotCache,
+                                snapshots_by_host: Dict[str, asyncio.Task], text_file: pathlib.Path,
+                                strict: bool) -> None:
+    try:
+        with text_file.open('rb') as binary_file:
+            if not is_zim_wiki_file(binary_file):
+                return
+
+            logger.debug("{0} is a zim wiki file!".format(text_file))
+
+            # Zim pages can be big (ex: journal pages), so we look for urls line by line (the header has none)
+            # instead of loading the whole page. We only need the whole page later, to add the archive links.
+            with io.TextIOWrapper(binary_file, encoding='utf8') as f:
+                urls_to_archive = get_urls_to_archive_from_lines(f, strict)
 
-        if first_line != "Content-Type: text/x-zim-wiki":
-            return
+                # Nothing to archive (the common case once a notebook has been crawled), so the page stays as is.
+                if not urls_to_archive:
+                    return
 
-        logger.debug("{0} is a zim wiki file!".format(text_file))
-        urls_to_archive = get_urls_to_archive_from_text(file_contents)
+                f.seek(0)
+                file_contents = f.read()
+    except UnicodeDecodeError:
+        logger.error("Text file \"{0}\" got UnicodeDecodeError. Skipping.".format(text_file))
+        return
 
-        logger.info("{0} URLs to archive: {1}".format(text_file, ', '.join(urls_to_archive)))
+    logger.info("{0} URLs to archive: {1}".format(text_file, ', '.join(urls_to_archive)))
 
-        archived_urls = archive_links(urls_to_archive)
+    archived_urls = await archive_links(session, urls_to_archive, cache, snapshots_by_host)
+
+    logger.info("{0} Archived URLs: {1}".format(text_file, ', '.join(map(str, archived_urls))))
+
+    if not archived_urls:
+        return
+
+    new_file_contents = edit_text(file_contents, archived_urls)
+
+    print(new_file_contents)
+
+    # if new_file_contents != file_contents:
+    #    text_file.write_text(new_file_contents)
+
+
+async def crawl_notebook_and_archive_links(zim_notebook_directory: str, strict: bool = False) -> None:
+    text_files = pathlib.Path(zim_notebook_directory).rglob('*.txt')
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+    snapshots_by_host = {}
 
-        logger.info("{0} Archived URLs: {1}".format(text_file, ', '.join(map(str, archived_urls))))
+    # Every request goes to archive.org, so one session for the whole crawl lets us reuse the
+    # same keep-alive connections (and skip the DNS lookups and TLS handshakes) for every link.
+    connector = aiohttp.TCPConnector(limit=16, limit_per_host=4, keepalive_timeout=60)
 
-        new_file_contents = edit_text(file_contents, archived_urls)
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
 
-        print(new_file_contents)
+    with closing(SnapshotCache(os.path.join(CACHE_DIRECTORY, "cache.sqlite"))) as cache:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def archive_links_in_file_when_ready(text_file: pathlib.Path) -> None:
+                async with semaphore:
+                    await archive_links_in_file(session, cache, snapshots_by_host, text_file, strict)
 
-        # if new_file_contents != file_contents:
-        #    text_file.write_text(new_file_contents)
+            # Pages are independent of each other, so we process a few of them at the same time. The
+            # save_throttle is shared by all of them, so together they still respect archive.org's rate limit.
+            await asyncio.gather(*(archive_links_in_file_when_ready(text_file) for text_file in text_files))
 
 
 def main():
@@ -257,7 +736,7 @@ def main():
 
     logger.setLevel(logging.getLevelName(args.log_level))
 
-    crawl_notebook_and_archive_links(args.zim_notebook_directory)
+    asyncio.run(crawl_notebook_and_archive_links(args.zim_notebook_directory, args.strict))
 
 
 if __name__ == "__main__":